@@ -4,6 +4,67 @@ import tensorflow_gan as tfgan
 
 import galaxy2galaxy.layers.spectral_ops as ops
 
+@contextlib.contextmanager
+def _null_scope():
+  yield
+
+def maybe_jit_scope(use_xla):
+  """Returns an XLA JIT scope if `use_xla` is set, a no-op context otherwise.
+  Ops created under the scope are clustered and compiled by XLA, which fuses
+  the many small elementwise kernels into a handful of larger ones. Shapes
+  should be static (fixed batch size) to avoid recompilations.
+  Args:
+    use_xla: Boolean, whether to compile the enclosed ops with XLA.
+  Returns:
+    A context manager.
+  """
+  if use_xla:
+    return tf.xla.experimental.jit_scope(compile_ops=True)
+  return _null_scope()
+
+def _scale_gradient(x, scale):
+  """Identity in the forward pass, multiplies the gradient by `scale`."""
+  @tf.custom_gradient
+  def _identity(x):
+    return tf.identity(x), lambda dy: dy * scale
+  return _identity(x)
+
+def loss_scaled_cast(x, dtype, loss_scale=1.):
+  """Casts `x` to `dtype`, applying a static loss scale across the cast.
+  Gradients flowing back into a lower precision region are multiplied by
+  `loss_scale`, and divided by it when they leave that region, so that small
+  float16 gradients don't underflow while the float32 ones are unchanged.
+  Args:
+    x: The input tensor or variable.
+    dtype: The dtype to cast to.
+    loss_scale: Float, the static loss scale.
+  Returns:
+    The cast tensor.
+  """
+  dtype = tf.as_dtype(dtype)
+  if x.dtype.base_dtype == dtype or loss_scale == 1.:
+    return tf.cast(x, dtype)
+  if dtype.size < x.dtype.base_dtype.size:
+    return tf.cast(_scale_gradient(x, 1. / loss_scale), dtype)
+  return _scale_gradient(tf.cast(x, dtype), loss_scale)
+
+def fused_batch_norm_1d(x, name, training=True):
+  """Batch normalization of a 2D [batch, channels] tensor using the fused kernel.
+  The input is reshaped to [batch, 1, 1, channels] so that the normalization
+  runs as a single fused cuDNN kernel instead of a chain of elementwise ops.
+  Variables are the same as for `tf.layers.batch_normalization`.
+  Args:
+    x: The 2D input tensor.
+    name: The variable scope name for the layer.
+    training: Whether to use batch statistics and update the moving averages.
+  Returns:
+    The normalized 2D tensor.
+  """
+  channels = x.shape[-1].value
+  x = tf.reshape(x, [-1, 1, 1, channels])
+  x = tf.layers.batch_normalization(x, name=name, training=training, fused=True)
+  return tf.reshape(x, [-1, channels])
+
 def usample(x):
   """Upsamples the input volume.
   Args:
@@ -13,6 +13,7 @@ import numpy as np
 import collections
 import functools
 from tensorflow_probability.python.bijectors import affine_scalar
+from tensorflow_probability.python.bijectors.masked_autoregressive import _gen_mask, MASK_EXCLUSIVE, MASK_INCLUSIVE
 from tensorflow_probability.python.bijectors import bijector as bijector_lib
 from tensorflow_probability.python.internal import tensorshape_util
 from tensorflow_probability.python.bijectors import bijector
@@ -20,6 +21,7 @@ from tensorflow_probability.python.internal import assert_util
 from tensorflow_probability.python.internal import dtype_util
 from tensorflow_probability.python.internal import tensorshape_util
 
+from galaxy2galaxy.layers.common_layers import loss_scaled_cast
 from galaxy2galaxy.layers.tfp_utils import RationalQuadraticSpline
 
 tfd = tfp.distributions
@@ -39,9 +41,25 @@ def masked_autoregressive_conditional_template(hidden_layers,
                                            log_scale_max_clip=3.,
                                            log_scale_clip_gradient=False,
                                            name=None,
+                                           dtype=tf.float32,
+                                           loss_scale=1.,
+                                           permutation=None,
                                            *args,  # pylint: disable=keyword-arg-before-vararg
                                            **kwargs):
+  """Conditional MADE template. The conditional tensor is concatenated in front
+  of the inputs and given the first degrees of the autoregressive ordering, so
+  every output can depend on it without a separate conditioning network.
+  If a `permutation` of the inputs is provided, the autoregressive ordering
+  follows `x[permutation[0]], x[permutation[1]], ...`. The permutation is
+  folded into the masks of the first and last layers, which makes an explicit
+  `tfb.Permute` between MAF layers unnecessary.
+  If `dtype` is not float32, the MLP is evaluated in that dtype while its
+  variables are stored in float32, and the returned shift and log_scale are
+  cast back to the dtype of the input. `loss_scale` is then applied to the
+  gradients inside the MLP to keep them from underflowing.
+  """
   name = name or "masked_autoregressive_default_template"
+  dtype = tf.as_dtype(dtype)
   with tf.name_scope(name, values=[log_scale_min_clip, log_scale_max_clip]):
     def _fn(x):
       """MADE parameterized via `masked_autoregressive_default_template`."""
@@ -53,8 +71,9 @@ def masked_autoregressive_conditional_template(hidden_layers,
       if len(x.shape) == 1:
         x = x[tf.newaxis, ...]
 
-
-      x = tf.concat([conditional_tensor, x],  axis=1)
+      output_dtype = x.dtype
+      x = tf.concat([loss_scaled_cast(conditional_tensor, dtype, loss_scale),
+                     loss_scaled_cast(x, dtype, loss_scale)],  axis=1)
       cond_depth = conditional_tensor.shape.with_rank_at_least(1)[-1].value
       input_depth = x.shape.with_rank_at_least(1)[-1].value
 
@@ -62,31 +81,43 @@ def masked_autoregressive_conditional_template(hidden_layers,
         raise NotImplementedError(
             "Rightmost dimension must be known prior to graph execution.")
 
+      # Position of each input in the autoregressive ordering, the conditional
+      # tensor always comes first
+      if permutation is None:
+        order = None
+      else:
+        order = np.concatenate([np.arange(cond_depth),
+                                cond_depth + np.argsort(permutation)])
+
       for i, units in enumerate(hidden_layers):
-        x = tfb.masked_dense(
+        x = _masked_dense(
             inputs=x,
             units=units,
             num_blocks=input_depth,
             exclusive=True if i == 0 else False,
             activation=activation,
+            input_order=order if i == 0 else None,
             *args,  # pylint: disable=keyword-arg-before-vararg
             **kwargs)
 
-      x = tfb.masked_dense(
+      x = _masked_dense(
           inputs=x,
           units=(1 if shift_only else 2) * input_depth,
           num_blocks=input_depth,
           activation=None,
+          input_order=order if len(hidden_layers) == 0 else None,
+          output_order=order,
           *args,  # pylint: disable=keyword-arg-before-vararg
           **kwargs)
 
       if shift_only:
         x = x[:, cond_depth:]
-        x = tf.reshape(x, shape=input_shape)
+        x = tf.reshape(loss_scaled_cast(x, output_dtype, loss_scale), shape=input_shape)
         return x, None
       else:
         x = x[:, 2*cond_depth:]
-      x = tf.reshape(x, shape=tf.concat([input_shape, [2]], axis=0))
+      x = tf.reshape(loss_scaled_cast(x, output_dtype, loss_scale),
+                     shape=tf.concat([input_shape, [2]], axis=0))
       shift, log_scale = tf.unstack(x, num=2, axis=-1)
       which_clip = (
           tf.clip_by_value
@@ -94,7 +125,71 @@ def masked_autoregressive_conditional_template(hidden_layers,
       log_scale = which_clip(log_scale, log_scale_min_clip, log_scale_max_clip)
       return shift, log_scale
 
-    return tf.make_template(name, _fn)
+    custom_getter = (None if dtype == tf.float32
+                     else _float32_variable_storage_getter(loss_scale))
+    return tf.make_template(name, _fn, custom_getter_=custom_getter)
+
+def _permuted_mask(num_blocks, n_in, n_out, exclusive=False,
+                   input_order=None, output_order=None):
+  """Binary [n_in, n_out] MADE mask, with the blocks of the input and output
+  degrees reordered according to `input_order` and `output_order`."""
+  def _block_index(order, block_size):
+    return (np.asarray(order)[:, np.newaxis] * block_size +
+            np.arange(block_size)).reshape(-1)
+
+  mask = _gen_mask(num_blocks, n_in, n_out,
+                   MASK_EXCLUSIVE if exclusive else MASK_INCLUSIVE).T
+  if input_order is not None:
+    mask = mask[_block_index(input_order, n_in // num_blocks), :]
+  if output_order is not None:
+    mask = mask[:, _block_index(output_order, n_out // num_blocks)]
+  return mask
+
+def _masked_dense(inputs, units, num_blocks, exclusive=False,
+                  input_order=None, output_order=None, kernel_initializer=None,
+                  name=None, *args, **kwargs):
+  """Same as `tfb.masked_dense`, with the blocks of the input and output
+  degrees reordered according to `input_order` and `output_order`."""
+  if input_order is None and output_order is None:
+    return tfb.masked_dense(inputs=inputs, units=units, num_blocks=num_blocks,
+                            exclusive=exclusive,
+                            kernel_initializer=kernel_initializer, name=name,
+                            *args, **kwargs)
+
+  input_depth = inputs.shape.with_rank_at_least(1)[-1].value
+  mask = _permuted_mask(num_blocks, input_depth, units, exclusive=exclusive,
+                        input_order=input_order, output_order=output_order)
+
+  if kernel_initializer is None:
+    kernel_initializer = tf.glorot_normal_initializer()
+
+  def masked_initializer(shape, dtype=None, partition_info=None):
+    return mask * kernel_initializer(shape, dtype, partition_info)
+
+  with tf.name_scope(name, "masked_dense", [inputs, units, num_blocks]):
+    layer = tf.layers.Dense(
+        units,
+        kernel_initializer=masked_initializer,
+        kernel_constraint=lambda x: mask * x,
+        name=name,
+        dtype=inputs.dtype.base_dtype,
+        _scope=name,
+        *args,  # pylint: disable=keyword-arg-before-vararg
+        **kwargs)
+    return layer.apply(inputs)
+
+def _float32_variable_storage_getter(loss_scale=1.):
+  """Returns a custom getter storing trainable variables in float32 and casting
+  them to the requested dtype, for mixed precision training."""
+  def _getter(getter, name, shape=None, dtype=None, trainable=True,
+              *args, **kwargs):
+    storage_dtype = tf.float32 if trainable else dtype
+    variable = getter(name, shape, dtype=storage_dtype, trainable=trainable,
+                      *args, **kwargs)
+    if trainable and dtype != tf.float32:
+      variable = loss_scaled_cast(variable, dtype, loss_scale)
+    return variable
+  return _getter
 
 def _clip_by_value_preserve_grad(x, clip_value_min, clip_value_max, name=None):
   """Clips input while leaving gradient unaltered."""
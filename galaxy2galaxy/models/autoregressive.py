@@ -16,8 +16,9 @@ from tensor2tensor.utils import registry
 from tensor2tensor.utils import t2t_model
 from pixel_cnn_pp.model import model_spec
 
+from galaxy2galaxy.layers.common_layers import maybe_jit_scope
+
 import tensorflow as tf
-import tensorflow_probability as tfp
 import tensorflow_hub as hub
 
 def pack_images(images, rows, cols):
@@ -60,13 +61,17 @@ class Img2imgPixelCnn(t2t_model.T2TModel):
 
     def pixel_cnn_fn(input_layer):
       model = tf.make_template('model', model_spec)
-      out = model(input_layer, None, ema=None, **model_opt)
-      out = tf.layers.dense(out, 2, activation=None)
-      loc, scale = tf.split(out, num_or_size_splits=2, axis=-1)
-      scale = tf.nn.softplus(scale) + 1e-4
-      distribution = tfp.distributions.Independent( tfp.distributions.Normal(loc=loc, scale=scale))
-      sample = distribution.sample()
-      log_prob = distribution.log_prob(input_layer)
+      # PixelCNN++ is made of many small concat_elu/nin ops, compiling the
+      # network together with the output projection lets XLA fuse them
+      with maybe_jit_scope(hparams.use_xla):
+        out = model(input_layer, None, ema=None, **model_opt)
+        out = tf.layers.dense(out, 2, activation=None)
+        loc = out[..., :1]
+        scale = tf.nn.softplus(out[..., 1:]) + 1e-4
+        # Independent per-pixel Normal, written out to skip TFP's dispatch
+        sample = loc + scale * tf.random_normal(tf.shape(loc))
+        log_prob = - 0.5 * tf.square((input_layer - loc) / scale) - tf.log(scale) - 0.5 * np.log(2. * np.pi)
+        log_prob = tf.reduce_sum(log_prob, axis=[-3, -2, -1])
       grads = tf.gradients(log_prob, input_layer)[0]
       print(grads)
       output = {'sample': sample, 'log_prob': log_prob,
@@ -128,4 +133,6 @@ def pixelcnnpp_base():
   # PixelCNN model opt
   hparams.add_hparam("nr_resnet", 2)
   hparams.add_hparam("num_channels", 1)
+  # Compile parts of the model with XLA, requires a fixed batch_size
+  hparams.add_hparam("use_xla", False)
   return hparams
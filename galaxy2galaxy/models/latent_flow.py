@@ -6,6 +6,7 @@ from __future__ import division
 from __future__ import print_function
 
 import copy
+import json
 import numpy as np
 
 from tensor2tensor.layers import common_attention
@@ -15,6 +16,7 @@ from tensor2tensor.layers import modalities
 from tensor2tensor.utils import registry
 from tensor2tensor.utils import t2t_model
 
+from galaxy2galaxy.layers.common_layers import maybe_jit_scope, fused_batch_norm_1d, loss_scaled_cast
 from galaxy2galaxy.layers.flows import masked_autoregressive_conditional_template, ConditionalNeuralSpline, conditional_neural_spline_template, autoregressive_conditional_neural_spline_template
 from galaxy2galaxy.layers.tfp_utils import RealNVP, MaskedAutoregressiveFlow
 
@@ -24,6 +26,21 @@ import tensorflow_probability as tfp
 tfb = tfp.bijectors
 tfd = tfp.distributions
 
+_ENCODER_COLLECTION = "g2g_encoder_modules"
+
+def _load_encoder(encoder_spec, encoder_module):
+  """ Instantiates the frozen encoder once per graph, so that repeated model
+  construction (e.g. one call per data shard) reuses the same module. The
+  module is kept in a collection of the default graph, which ties its
+  lifetime to the graph.
+  """
+  for path, encoder in tf.get_collection(_ENCODER_COLLECTION):
+    if path == encoder_module:
+      return encoder
+  encoder = hub.Module(encoder_spec, trainable=False)
+  tf.add_to_collection(_ENCODER_COLLECTION, (encoder_module, encoder))
+  return encoder
+
 class LatentFlow(t2t_model.T2TModel):
   """ Base class for latent flows
 
@@ -31,6 +48,10 @@ class LatentFlow(t2t_model.T2TModel):
   in hparams.
   """
 
+  # Exported flow module specs, keyed by model class and hparams. A spec does
+  # not depend on the graph, so it only needs to be traced once per process
+  _flow_specs = {}
+
   def normalizing_flow(self, condition):
     """ Function building a normalizing flow, returned as a Tensorflow probability
     distribution
@@ -52,20 +73,20 @@ class LatentFlow(t2t_model.T2TModel):
     hparams = self.hparams
     hparamsp = hparams.problem.get_hparams()
 
-    x = features['inputs']
     cond = {k: features[k] for k in hparamsp.attributes}
 
-    # Load the encoder and decoder modules
-    encoder = hub.Module(hparams.encoder_module, trainable=False)
+    # Only the spec of the encoder is needed to get the shape of the code
+    encoder_spec = hub.load_module_spec(hparams.encoder_module)
 
-    latent_shape = encoder.get_output_info_dict()['default'].get_shape()[1:]
+    latent_shape = encoder_spec.get_output_info_dict()['default'].get_shape()[1:]
     latent_size = latent_shape[0].value*latent_shape[1].value*latent_shape[2].value
-    code_shape = encoder.get_output_info_dict()['default'].get_shape()
+    code_shape = encoder_spec.get_output_info_dict()['default'].get_shape()
     code_shape = [-1, code_shape[1].value, code_shape[2].value, code_shape[3].value]
 
     def get_flow(inputs, is_training=True):
-      y = tf.concat([tf.expand_dims(inputs[k], axis=1) for k in hparamsp.attributes] ,axis=1)
-      y = tf.layers.batch_normalization(y, name="y_norm", training=is_training)
+      y = tf.stack([inputs[k] for k in hparamsp.attributes], axis=1)
+      if not hparams.y_is_prewhitened:
+        y = fused_batch_norm_1d(y, name="y_norm", training=is_training)
       flow = self.normalizing_flow(y, latent_size)
       return flow
 
@@ -74,31 +95,55 @@ class LatentFlow(t2t_model.T2TModel):
       def flow_module_spec():
         inputs_params = {k: tf.placeholder(tf.float32, shape=[None]) for k in hparamsp.attributes}
         random_normal = tf.placeholder(tf.float32, shape=[None, latent_size])
-        flow = get_flow(inputs_params, is_training=False)
-        samples = flow._bijector.forward(random_normal)
+        with maybe_jit_scope(hparams.use_xla):
+          flow = get_flow(inputs_params, is_training=False)
+          samples = flow._bijector.forward(tf.cast(random_normal, flow.dtype))
+          samples = tf.cast(samples, tf.float32)
         samples = tf.reshape(samples, code_shape)
         hub.add_signature(inputs={**inputs_params, 'random_normal': random_normal},
                           outputs=samples)
-      flow_spec = hub.create_module_spec(flow_module_spec)
+      spec_key = (type(self), tuple(hparamsp.attributes),
+                  json.dumps(hparams.values(), sort_keys=True, default=str))
+      if spec_key not in LatentFlow._flow_specs:
+        LatentFlow._flow_specs[spec_key] = hub.create_module_spec(flow_module_spec)
+      flow_spec = LatentFlow._flow_specs[spec_key]
       flow = hub.Module(flow_spec, name='flow_module')
       hub.register_module_for_export(flow, "code_sampler")
-      cond['random_normal'] = tf.random_normal(shape=[tf.shape(cond[hparamsp.attributes[0]])[0] , latent_size])
+      # Use a static batch size when known to keep the sampler shapes static
+      attr = cond[hparamsp.attributes[0]]
+      batch_size = attr.shape[0].value or tf.shape(attr)[0]
+      cond['random_normal'] = tf.random_normal(shape=[batch_size, latent_size])
       samples = flow(cond)
       return samples, {'loglikelihood': 0}
 
-    # Encode the input image
-    if hparams.encode_psf and 'psf' in features:
-      code = encoder({'input':x, 'psf': features['psf']})
+    # Use precomputed codes if the problem provides them, otherwise encode the
+    # input image
+    if 'code' in features:
+      code = tf.reshape(features['code'], code_shape)
     else:
-      code = encoder(x)
-
-    with tf.variable_scope("flow_module"):
+      x = features['inputs']
+      encoder = _load_encoder(encoder_spec, hparams.encoder_module)
+      if hparams.encode_psf and 'psf' in features:
+        code = encoder({'input':x, 'psf': features['psf']})
+      else:
+        code = encoder(x)
+
+    if code.shape[1:].num_elements() != latent_size:
+      raise ValueError("Code of shape %s does not match the latent size %d "
+                       "of the encoder" % (code.shape, latent_size))
+
+    # The encoder stays outside of the XLA cluster, only the flow is compiled
+    with tf.variable_scope("flow_module"), maybe_jit_scope(hparams.use_xla):
       flow = get_flow(cond)
-      loglikelihood = flow.log_prob(tf.layers.flatten(code))
-
-    # This is the loglikelihood of a batch of images
-    tf.summary.scalar('loglikelihood', tf.reduce_mean(loglikelihood))
-    loss = - tf.reduce_mean(loglikelihood)
+      loss_scale = hparams.get("mixed_precision_loss_scale", 1.)
+      flat_code = loss_scaled_cast(tf.reshape(code, [-1, latent_size]), flow.dtype, loss_scale)
+      loglikelihood = loss_scaled_cast(flow.log_prob(flat_code), tf.float32, loss_scale)
+
+    # This is the loglikelihood of a batch of images, the summary reuses the
+    # same reduction as the loss
+    mean_loglikelihood = tf.reduce_mean(loglikelihood)
+    tf.summary.scalar('loglikelihood', mean_loglikelihood)
+    loss = - mean_loglikelihood
     return code, {'training': loss}
 
 @registry.register_model
@@ -107,27 +152,57 @@ class LatentMAF(LatentFlow):
   def normalizing_flow(self, conditioning, latent_size):
     """
     Normalizing flow based on Masked AutoRegressive Model.
+
+    The orderings of the MAF layers are drawn at graph construction from
+    `hparams.seed`, the same seed always reproduces the same flow.
     """
     hparams = self.hparams
 
-    def init_once(x, name, trainable=False):
-      return tf.get_variable(name, initializer=x, trainable=trainable)
+    maf_dtype = tf.float16 if hparams.mixed_precision else tf.float32
+    prior_dtype = tf.as_dtype(hparams.prior_dtype or maf_dtype)
+    if prior_dtype not in (tf.float32, maf_dtype):
+      raise ValueError("prior_dtype must be float32 or %s, got %s"
+                       % (maf_dtype.name, prior_dtype.name))
 
-    chain = []
-    for i in range(hparams.num_hidden_layers):
-      chain.append(tfb.MaskedAutoregressiveFlow(
+    def ordering(i):
+      return np.random.RandomState([hparams.seed, i]).permutation(latent_size).astype("int32")
+
+    def maf_step(i, permutation=None):
+      return tfb.MaskedAutoregressiveFlow(
                   shift_and_log_scale_fn=masked_autoregressive_conditional_template(
                   hidden_layers=[hparams.hidden_size, hparams.hidden_size],
                       conditional_tensor=conditioning, shift_only=False,
                       activation=common_layers.belu, name='maf%d'%i,
-                      log_scale_min_clip=-3., log_scale_clip_gradient=True)))
-      chain.append(tfb.Permute(permutation=init_once(
-                           np.random.permutation(latent_size).astype("int32"),
-                           name='permutation%d'%i)))
-    chain = tfb.Chain(chain)
-
-    flow = tfd.TransformedDistribution(distribution=tfd.MultivariateNormalDiag(loc=np.zeros(latent_size, dtype='float32'),
-                                                                               scale_diag=np.ones(latent_size, dtype='float32')),
+                      log_scale_min_clip=-3., log_scale_clip_gradient=True,
+                      dtype=maf_dtype,
+                      loss_scale=hparams.mixed_precision_loss_scale,
+                      permutation=permutation),
+                  validate_args=False)
+
+    if hparams.legacy_permutations:
+      # Layout of the checkpoints trained before the orderings were folded into
+      # the MADE masks: explicit tfb.Permute with permutations stored in variables
+      def permute_step(i):
+        return tfb.Permute(permutation=tf.get_variable('permutation%d'%i,
+                                                       initializer=ordering(i),
+                                                       trainable=False),
+                           validate_args=False)
+      steps = [b for i in range(hparams.num_hidden_layers)
+               for b in (maf_step(i), permute_step(i))]
+    else:
+      # Each MAF layer uses its own ordering of the latent variables, folded
+      # into the MADE masks. The marker variable is missing from checkpoints
+      # with the legacy layout, so restoring one fails instead of silently
+      # loading kernels that were trained with different masks
+      tf.get_variable('folded_permutations', shape=[], dtype=tf.int32,
+                      initializer=tf.zeros_initializer(), trainable=False)
+      steps = [maf_step(i, ordering(i)) for i in range(hparams.num_hidden_layers)]
+
+    # No runtime assertions between steps, the shapes are fixed at graph build
+    chain = tfb.Chain(steps, validate_args=False)
+
+    flow = tfd.TransformedDistribution(distribution=tfd.MultivariateNormalDiag(loc=tf.zeros([latent_size], dtype=prior_dtype),
+                                                                               scale_diag=tf.ones([latent_size], dtype=prior_dtype)),
             bijector=chain)
     return flow
 
@@ -161,8 +236,8 @@ class LatentNSF(LatentFlow):
     chain.append(tfb.Affine(scale_identity_multiplier=0.1))
     chain = tfb.Chain(chain)
 
-    flow = tfd.TransformedDistribution(distribution=tfd.MultivariateNormalDiag(loc=np.zeros(latent_size, dtype='float32'),
-                                                                               scale_diag=np.ones(latent_size, dtype='float32')),
+    flow = tfd.TransformedDistribution(distribution=tfd.MultivariateNormalDiag(loc=tf.zeros([latent_size], dtype=tf.float32),
+                                                                               scale_diag=tf.ones([latent_size], dtype=tf.float32)),
             bijector=chain)
     return flow
 
@@ -196,8 +271,8 @@ class LatentMafNsf(LatentFlow):
     chain.append(tfb.Affine(scale_identity_multiplier=0.1))
     chain = tfb.Chain(chain)
 
-    flow = tfd.TransformedDistribution(distribution=tfd.MultivariateNormalDiag(loc=np.zeros(latent_size, dtype='float32'),
-                                                                               scale_diag=np.ones(latent_size, dtype='float32')),
+    flow = tfd.TransformedDistribution(distribution=tfd.MultivariateNormalDiag(loc=tf.zeros([latent_size], dtype=tf.float32),
+                                                                               scale_diag=tf.ones([latent_size], dtype=tf.float32)),
             bijector=chain)
     return flow
 
@@ -226,6 +301,29 @@ def latent_flow():
   # hparams related to the PSF
   hparams.add_hparam("encode_psf", True) # Should we use the PSF at the encoder
 
+  # Seed used to draw the fixed orderings of the flow
+  hparams.add_hparam("seed", 0)
+  # Set to True to load LatentMAF checkpoints trained with explicit Permute
+  # bijectors between MAF layers
+  hparams.add_hparam("legacy_permutations", False)
+
+  # Compile the flow with XLA, batch_size should be kept fixed to avoid recompilations
+  hparams.add_hparam("use_xla", False)
+
+  # Evaluate the MAF networks in float16, with a static loss scale applied to
+  # their gradients. T2T's activation_dtype is not used, its float16 custom
+  # getter casts every variable of the model to float16, which the fused batch
+  # norm of the conditions does not support
+  hparams.add_hparam("mixed_precision", False)
+  hparams.add_hparam("mixed_precision_loss_scale", 1024.)
+  # Dtype of the MAF base distribution and bijectors, either float32 or the
+  # dtype of the MAF networks, which is the default. The loss is always float32
+  hparams.add_hparam("prior_dtype", "")
+
+  # Set to True if the problem already standardizes the attributes, the
+  # normalization of the conditions is then skipped
+  hparams.add_hparam("y_is_prewhitened", False)
+
   return hparams
 
 
@@ -254,6 +352,29 @@ def latent_flow_larger():
   # hparams related to the PSF
   hparams.add_hparam("encode_psf", True) # Should we use the PSF at the encoder
 
+  # Seed used to draw the fixed orderings of the flow
+  hparams.add_hparam("seed", 0)
+  # Set to True to load LatentMAF checkpoints trained with explicit Permute
+  # bijectors between MAF layers
+  hparams.add_hparam("legacy_permutations", False)
+
+  # Compile the flow with XLA, batch_size should be kept fixed to avoid recompilations
+  hparams.add_hparam("use_xla", False)
+
+  # Evaluate the MAF networks in float16, with a static loss scale applied to
+  # their gradients. T2T's activation_dtype is not used, its float16 custom
+  # getter casts every variable of the model to float16, which the fused batch
+  # norm of the conditions does not support
+  hparams.add_hparam("mixed_precision", False)
+  hparams.add_hparam("mixed_precision_loss_scale", 1024.)
+  # Dtype of the MAF base distribution and bijectors, either float32 or the
+  # dtype of the MAF networks, which is the default. The loss is always float32
+  hparams.add_hparam("prior_dtype", "")
+
+  # Set to True if the problem already standardizes the attributes, the
+  # normalization of the conditions is then skipped
+  hparams.add_hparam("y_is_prewhitened", False)
+
   return hparams
 
 @registry.register_hparams
@@ -283,4 +404,11 @@ def latent_flow_nsf():
   # hparams related to the PSF
   hparams.add_hparam("encode_psf", True) # Should we use the PSF at the encoder
 
+  # Compile the flow with XLA, batch_size should be kept fixed to avoid recompilations
+  hparams.add_hparam("use_xla", False)
+
+  # Set to True if the problem already standardizes the attributes, the
+  # normalization of the conditions is then skipped
+  hparams.add_hparam("y_is_prewhitened", False)
+
   return hparams
@@ -0,0 +1,175 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+import tensorflow_hub as hub
+
+from galaxy2galaxy.layers.common_layers import loss_scaled_cast
+from galaxy2galaxy.layers.flows import _permuted_mask, masked_autoregressive_conditional_template
+from galaxy2galaxy.models import latent_flow
+
+COND_DEPTH = 2
+LATENT_SIZE = 5
+PERMUTATION = np.array([3, 0, 4, 1, 2])
+
+def _allowed_inputs(q):
+  """Inputs x[q]'s shift/log_scale may depend on: the conditions and the
+  variables placed before it in the ordering."""
+  rank = np.argsort(PERMUTATION)[q]
+  return set(range(COND_DEPTH)) | set(COND_DEPTH + PERMUTATION[:rank])
+
+def test_permuted_masks():
+  input_depth = COND_DEPTH + LATENT_SIZE
+  order = np.concatenate([np.arange(COND_DEPTH),
+                          COND_DEPTH + np.argsort(PERMUTATION)])
+  hidden_size = 3 * input_depth
+  masks = [_permuted_mask(input_depth, input_depth, hidden_size,
+                          exclusive=True, input_order=order),
+           _permuted_mask(input_depth, hidden_size, hidden_size),
+           _permuted_mask(input_depth, hidden_size, 2 * input_depth,
+                          output_order=order)]
+  connectivity = masks[0].dot(masks[1]).dot(masks[2]) > 0
+
+  for q in range(LATENT_SIZE):
+    for k in range(2): # shift and log_scale
+      inputs = set(np.where(connectivity[:, 2 * (COND_DEPTH + q) + k])[0])
+      assert inputs == _allowed_inputs(q)
+
+def test_permuted_template_is_autoregressive():
+  with tf.Graph().as_default():
+    cond = tf.constant(np.random.randn(1, COND_DEPTH).astype('float32'))
+    x = tf.constant(np.random.randn(1, LATENT_SIZE).astype('float32'))
+    fn = masked_autoregressive_conditional_template(
+        hidden_layers=[16, 16], conditional_tensor=cond,
+        activation=tf.nn.tanh, permutation=PERMUTATION)
+    shift, log_scale = fn(x)
+    grads = [tf.gradients(shift[:, q] + log_scale[:, q], [cond, x])
+             for q in range(LATENT_SIZE)]
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      grads = sess.run(grads)
+
+  for q, (grad_cond, grad_x) in enumerate(grads):
+    inputs = set(np.where(np.abs(grad_cond[0]) > 0)[0])
+    inputs |= set(COND_DEPTH + np.where(np.abs(grad_x[0]) > 0)[0])
+    assert inputs == _allowed_inputs(q)
+
+def test_loss_scaled_cast():
+  with tf.Graph().as_default():
+    x = tf.constant([1., 2., 3.])
+    h = loss_scaled_cast(x, tf.float16, 1024.)
+    y = loss_scaled_cast(tf.square(h), tf.float32, 1024.)
+    grad_x, grad_h = tf.gradients(tf.reduce_sum(y), [x, h])
+    with tf.Session() as sess:
+      grad_x, grad_h = sess.run([grad_x, grad_h])
+
+  assert grad_h.dtype == np.float16
+  np.testing.assert_allclose(grad_h, 1024. * 2 * np.array([1., 2., 3.]))
+  np.testing.assert_allclose(grad_x, 2 * np.array([1., 2., 3.]))
+
+def _latent_maf(legacy_permutations=False, mixed_precision=False, prior_dtype=''):
+  hparams = latent_flow.latent_flow()
+  hparams.hidden_size = 32
+  hparams.num_hidden_layers = 2
+  hparams.legacy_permutations = legacy_permutations
+  hparams.mixed_precision = mixed_precision
+  hparams.prior_dtype = prior_dtype
+  model = latent_flow.LatentMAF(hparams, tf.estimator.ModeKeys.TRAIN)
+  cond = tf.constant(np.random.randn(8, COND_DEPTH).astype('float32'))
+  return model.normalizing_flow(cond, LATENT_SIZE)
+
+@pytest.mark.parametrize("legacy_permutations,mixed_precision",
+                         [(False, False), (True, False), (False, True)])
+def test_latent_maf_log_prob(legacy_permutations, mixed_precision):
+  with tf.Graph().as_default():
+    flow = _latent_maf(legacy_permutations, mixed_precision)
+    z = tf.constant(np.random.randn(8, LATENT_SIZE), dtype=flow.dtype)
+    x = flow.bijector.forward(z)
+    log_prob = flow.log_prob(x)
+    z_rec = flow.bijector.inverse(x)
+    grads = tf.gradients(tf.reduce_mean(log_prob), tf.trainable_variables())
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      z, z_rec, log_prob, grads = sess.run([z, z_rec, log_prob, grads])
+
+  assert log_prob.shape == (8,)
+  assert np.all(np.isfinite(log_prob))
+  for grad in grads:
+    assert grad.dtype == np.float32
+    assert np.all(np.isfinite(grad))
+  np.testing.assert_allclose(z_rec, z, atol=1e-2 if mixed_precision else 1e-4)
+
+def test_latent_maf_prior_dtype():
+  with tf.Graph().as_default():
+    assert _latent_maf(mixed_precision=True).dtype == tf.float16
+    with pytest.raises(ValueError):
+      _latent_maf(mixed_precision=True, prior_dtype='bfloat16')
+
+def test_latent_maf_rejects_legacy_checkpoint(tmpdir):
+  checkpoint = str(tmpdir.join('model.ckpt'))
+  with tf.Graph().as_default():
+    _latent_maf(legacy_permutations=True)
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      tf.train.Saver().save(sess, checkpoint)
+
+  with tf.Graph().as_default():
+    _latent_maf(legacy_permutations=False)
+    with tf.Session() as sess:
+      with pytest.raises(tf.errors.NotFoundError, match='folded_permutations'):
+        tf.train.Saver().restore(sess, checkpoint)
+
+class _Problem(object):
+  def get_hparams(self):
+    return tf.contrib.training.HParams(attributes=['a', 'b'])
+
+@pytest.fixture(scope='module')
+def encoder_module(tmpdir_factory):
+  """Exports a small hub encoder mapping 8x8 images to 2x2x2 codes."""
+  path = str(tmpdir_factory.mktemp('encoder'))
+  def encoder_fn():
+    x = tf.placeholder(tf.float32, shape=[None, 8, 8, 1])
+    hub.add_signature(inputs=x, outputs=tf.layers.conv2d(x, 2, 4, strides=4))
+  with tf.Graph().as_default():
+    encoder = hub.Module(hub.create_module_spec(encoder_fn))
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      encoder.export(path, sess)
+  return path
+
+def _latent_maf_model(encoder_module):
+  hparams = latent_flow.latent_flow()
+  hparams.hidden_size = 32
+  hparams.num_hidden_layers = 2
+  hparams.encoder_module = encoder_module
+  hparams.problem = _Problem()
+  return latent_flow.LatentMAF(hparams, tf.estimator.ModeKeys.TRAIN)
+
+def _attributes():
+  return {k: tf.constant(np.random.randn(4).astype('float32')) for k in ['a', 'b']}
+
+def _run_loss(loss):
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    return sess.run(loss)
+
+def test_latent_flow_precomputed_code(encoder_module):
+  with tf.Graph().as_default():
+    model = _latent_maf_model(encoder_module)
+    features = _attributes()
+    features['code'] = tf.constant(np.random.randn(4, 2, 2, 2).astype('float32'))
+    code, losses = model.body(features)
+    # The encoder is never instantiated
+    assert not tf.get_collection(latent_flow._ENCODER_COLLECTION)
+    assert np.isfinite(_run_loss(losses['training']))
+
+def test_latent_flow_encoder_is_shared(encoder_module):
+  with tf.Graph().as_default():
+    model = _latent_maf_model(encoder_module)
+    for reuse in [False, True]:
+      features = _attributes()
+      features['inputs'] = tf.constant(np.random.randn(4, 8, 8, 1).astype('float32'))
+      with tf.variable_scope('body', reuse=reuse):
+        code, losses = model.body(features)
+    assert len(tf.get_collection(latent_flow._ENCODER_COLLECTION)) == 1
+    assert code.shape.as_list() == [4, 2, 2, 2]
+    assert np.isfinite(_run_loss(losses['training']))